@@ -14,7 +14,6 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.optim.lr_scheduler import StepLR
 import torch.nn.functional as F
-import torch.autograd as autograd
 from torch.nn.utils.rnn import pad_packed_sequence
 import torchvision
 from src.utils import seqs2batch, ImageTransforms, TextTransforms, create_vocab, write_tensorboard
@@ -70,6 +69,9 @@ def config(net_params, data_params, opt_params, cuda_params):
         - cuda_params: dictionary with keys:
             'cuda': (bool): whether to use GPU or not
             'multigpu': (list of int): indices of GPUs to use
+            'compile': (bool): whether to compile the CNN and the LSTM losses with torch.compile
+                        or not (the LSTM itself is left to cuDNN)
+            'amp': (bool): whether to run the CNN and the LSTM with bfloat16 autocast or not
 
     Returns:
         - model: pytorch model to train
@@ -79,12 +81,13 @@ def config(net_params, data_params, opt_params, cuda_params):
 
     """
     model_type, input_dim, hidden_dim, margin, vocab_size, load_path, freeze = net_params
+    amp_dtype = torch.bfloat16 if cuda_params['amp'] else None
 
 
     if model_type == 'inception':
 
         model = inception(input_dim, hidden_dim, vocab_size, data_params['batch_first'],
-                           dropout=0.7, freeze=freeze)
+                           dropout=0.7, freeze=freeze, amp_dtype=amp_dtype)
         img_size = 299
         img_trf = {'train': ImageTransforms(img_size + 6, 5, img_size, 0.5),
                    'test': ImageTransforms(img_size)}
@@ -96,7 +99,7 @@ def config(net_params, data_params, opt_params, cuda_params):
     elif model_type == 'vgg':
 
         model = vgg(input_dim, hidden_dim, vocab_size, data_params['batch_first'],
-                           dropout=0.7, freeze=freeze)
+                           dropout=0.7, freeze=freeze, amp_dtype=amp_dtype)
         img_size = 224
         norm_trf = torchvision.transforms.Normalize(mean=[0.485, 0.456, 0.406],std=[0.229, 0.224, 0.225])
         img_trf = {'train': ImageTransforms(img_size + 6, 5, img_size, 0.5),
@@ -108,7 +111,7 @@ def config(net_params, data_params, opt_params, cuda_params):
 
     elif model_type == 'squeezenet':
         model = squeezenet(input_dim, hidden_dim, vocab_size, data_params['batch_first'],
-                           dropout=0.7, freeze=freeze)
+                           dropout=0.7, freeze=freeze, amp_dtype=amp_dtype)
         img_size = 227
         norm_trf = torchvision.transforms.Normalize(mean=[0.485, 0.456, 0.406],std=[0.229, 0.224, 0.225])
         img_trf = {'train': ImageTransforms(img_size + 6, 5, img_size, 0.5),
@@ -139,6 +142,15 @@ def config(net_params, data_params, opt_params, cuda_params):
     if cuda_params['cuda']:
         print("Switching model to gpu")
         model.cuda()
+    if cuda_params['compile']:
+        if not hasattr(nn.Module, 'compile'):
+            raise RuntimeError("--compile needs torch >= 2.2 (nn.Module.compile), found torch %s"
+                               % torch.__version__)
+        print("Compiling the CNN")
+        # Compile in place (the state_dict keys do not change). The number of images changes
+        # with every batch, so use dynamic shapes instead of recompiling for each new size.
+        # The LSTM is not compiled: it would lose the cuDNN kernels.
+        model.cnn.compile(dynamic=True)
     if cuda_params['multigpu']:
         print("Switching model to multigpu")
         multgpu = ast.literal_eval(multigpu[0])
@@ -158,7 +170,10 @@ def config(net_params, data_params, opt_params, cuda_params):
     # Optimize only the layers with requires_grad = True, not the frozen layers:
     optimizer = optim.SGD(filter(lambda x: x.requires_grad, model.parameters()),
                           lr=opt_params['learning_rate'], weight_decay=opt_params['weight_decay'])
-    criterion = LSTMLosses(data_params['batch_first'], cuda_params['cuda'])
+    criterion = LSTMLosses(data_params['batch_first'])
+    if cuda_params['compile']:
+        # The losses are a few matmuls and elementwise ops over padded batches of variable size.
+        criterion.compile(dynamic=True)
     contrastive_criterion = SBContrastiveLoss(margin)
 
     return model, dataloaders, optimizer, criterion, contrastive_criterion
@@ -191,10 +206,7 @@ def train(train_params, dataloaders, cuda, batch_first, epoch_params):
             # Get a list of images and texts from sequences:
             images, texts, seq_lens, im_lookup_table, txt_lookup_table = seqs2batch(batch, vocab)
 
-            images = autograd.Variable(images)
-            texts = autograd.Variable(texts)
             if cuda:
-                hidden = (hidden[0].cuda(), hidden[1].cuda())
                 images = images.cuda()
                 texts = texts.cuda()
 
@@ -214,7 +226,7 @@ def train(train_params, dataloaders, cuda, batch_first, epoch_params):
             lstm_loss = fw_loss + bw_loss
             loss = lstm_loss + cont_loss
 
-            if np.isnan(loss.cpu().data.numpy()) or lstm_loss.cpu().data[0] < 0:
+            if np.isnan(loss.cpu().data.numpy()) or lstm_loss.item() < 0:
                 import epdb
                 epdb.set_trace()
 
@@ -278,9 +290,16 @@ def main():
     parser.add_argument('--batch_first', dest='batch_first', action='store_true')
     parser.add_argument('--no-batch_first', dest='batch_first', action='store_false')
     parser.add_argument('--multigpu', nargs='*', default=[], help='list of gpus to use')
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        help='run the CNN and the LSTM with bfloat16 autocast (GPU only)')
+    parser.add_argument('--compile', dest='compile', action='store_true',
+                        help='compile the CNN and the LSTM losses with torch.compile (needs '
+                        'torch >= 2.2, the LSTM is left to cuDNN)')
     parser.set_defaults(cuda=True)
     parser.set_defaults(freeze=False)
     parser.set_defaults(batch_first=True)
+    parser.set_defaults(compile=False)
+    parser.set_defaults(amp=False)
     args = parser.parse_args()
 
     filenames = {'train': 'train_no_dup.json',
@@ -309,7 +328,9 @@ def main():
         data_params=data_params,
         opt_params=opt_params,
         cuda_params={'cuda': args.cuda,
-                     'multigpu': args.multigpu})
+                     'multigpu': args.multigpu,
+                     'compile': args.compile,
+                     'amp': args.amp})
 
     print("before training: lr = %.4f" % optimizer.param_groups[0]['lr'])
 
@@ -56,7 +56,7 @@ class Evaluation(object):
             print("Please, specify a valid model type: inception, vgg or squeezenet"\
                   "instead of %s" % model_type)
             return
-        self.criterion = LSTMLosses(batch_first, cuda=cuda)
+        self.criterion = LSTMLosses(batch_first)
         self.batch_first = batch_first
         self.cuda = cuda
 
@@ -86,23 +86,24 @@ class Evaluation(object):
             # hidden = (hidden[0].cuda(), hidden[1].cuda())
 
         im_feats = torch.nn.functional.normalize(im_feats, p=2, dim=1)
-        out, _ = self.model.lstm(torch.autograd.Variable(im_feats).unsqueeze(0))
+        out, _ = self.model.lstm(im_feats.unsqueeze(0))
                                  # hidden)
         out = out.data
 
         fw_hiddens = out[0, :im_feats.size(0), :out.size(2) // 2]
         bw_hiddens = out[0, :im_feats.size(0), out.size(2) // 2:]
 
-        if self.cuda:
-            im_feats = im_feats.cuda()
-            x_values = x_values.cuda()
+        x_values = x_values.to(out.device)
 
-        fw_logprob = torch.nn.functional.log_softmax(torch.autograd.Variable(
-            torch.mm(fw_hiddens, x_values.permute(1, 0))), dim=1).data
-        bw_logprob = torch.nn.functional.log_softmax(torch.autograd.Variable(
-            torch.mm(bw_hiddens, x_values.permute(1, 0))), dim=1).data
-        score = torch.diag(fw_logprob[:, i_seq + 2 : i_seq + 2 + fw_logprob.size(0)]).mean() +\
-            torch.diag(bw_logprob[:, i_seq : i_seq + bw_logprob.size(0)]).mean()
+        # Targets of each step (next item for the forward direction, previous item for the
+        # backward one), sliced once from the zero padded sequence stored in x_values.
+        fw_targets = x_values[i_seq + 2 : i_seq + 2 + fw_hiddens.size(0)]
+        bw_targets = x_values[i_seq : i_seq + bw_hiddens.size(0)]
+        fw_logprob = (fw_hiddens * fw_targets).sum(1) - \
+            torch.logsumexp(torch.mm(fw_hiddens, x_values.permute(1, 0)), dim=1)
+        bw_logprob = (bw_hiddens * bw_targets).sum(1) - \
+            torch.logsumexp(torch.mm(bw_hiddens, x_values.permute(1, 0)), dim=1)
+        score = fw_logprob.mean() + bw_logprob.mean()
 
         # pylint: enable=E1101
 
@@ -128,13 +129,10 @@ class Evaluation(object):
 
     def get_img_feats(self, img_data):
         """Get the features for some images."""
-        images = torch.Tensor()
         # Disable complaints about no-member in torch
         # pylint: disable=E1101
-        for img in img_data:
-            images = torch.cat((images, torchvision.transforms.ToTensor()(self.trf(img)).unsqueeze(0)))
+        images = torch.stack([torchvision.transforms.ToTensor()(self.trf(img)) for img in img_data])
         # pylint: enable=E1101
-        images = torch.autograd.Variable(images)
         if self.cuda:
             images = images.cuda()
         if self.model.__module__ == 'model_squeezenet':
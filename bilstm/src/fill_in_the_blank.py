@@ -81,33 +81,29 @@ def main(model_name, model_type, feats_name, img_savepath, cuda):
         position = outfit['blank_position'] - 1
 
         if position == 0:
-            out, _ = model.lstm(torch.autograd.Variable(question_feats).unsqueeze(0))
+            out, _ = model.lstm(question_feats.unsqueeze(0))
             out = out.data
             bw_hidden = out[0, :question_feats.size(0), out.size(2) // 2:][0].view(1, -1)
-            pred = predict_single_direction(torch.autograd.Variable(bw_hidden),
-                                            torch.autograd.Variable(answers_feats))
+            pred = predict_single_direction(bw_hidden, answers_feats)
 
         elif position == len(question_feats):
-            out, _ = model.lstm(torch.autograd.Variable(question_feats).unsqueeze(0))
+            out, _ = model.lstm(question_feats.unsqueeze(0))
             out = out.data
             fw_hidden = out[0, :question_feats.size(0), :out.size(2) // 2][-1].view(1, -1)
-            pred = predict_single_direction(torch.autograd.Variable(fw_hidden),
-                                            torch.autograd.Variable(answers_feats))
+            pred = predict_single_direction(fw_hidden, answers_feats)
 
         else:
             prev = question_feats[:position]
-            prev_out, _ = model.lstm(torch.autograd.Variable(prev).unsqueeze(0))
+            prev_out, _ = model.lstm(prev.unsqueeze(0))
             prev_out = prev_out.data
             fw_hidden = prev_out[0, :prev.size(0), :prev_out.size(2) // 2][-1].view(1, -1)
 
             post = question_feats[position:]
-            post_out, _ = model.lstm(torch.autograd.Variable(post).unsqueeze(0))
+            post_out, _ = model.lstm(post.unsqueeze(0))
             post_out = post_out.data
             bw_hidden = post_out[0, :post.size(0), post_out.size(2) // 2:][0].view(1, -1)
 
-            pred = predict_multi_direction(torch.autograd.Variable(fw_hidden),
-                                           torch.autograd.Variable(bw_hidden),
-                                           torch.autograd.Variable(answers_feats))
+            pred = predict_multi_direction(fw_hidden, bw_hidden, answers_feats)
 
         create_img_fitb(outfit, pred[0].data[0], os.path.join(img_savepath, "%d_score%.2f.jpg" % (i, pred[1].data[0]*100)))
         scores.append(pred)
@@ -164,33 +160,29 @@ def main_single_prev(model_name, model_type, feats_name, img_savepath, cuda):
         position = outfit['blank_position'] - 1
 
         if position == 0:
-            out, _ = model.lstm(torch.autograd.Variable(question_feats[0]).unsqueeze(0).unsqueeze(0))
+            out, _ = model.lstm(question_feats[0].unsqueeze(0).unsqueeze(0))
             out = out.data
             bw_hidden = out[0, :question_feats.size(0), out.size(2) // 2:][0].view(1, -1)
-            pred = predict_single_direction(torch.autograd.Variable(bw_hidden),
-                                            torch.autograd.Variable(answers_feats))
+            pred = predict_single_direction(bw_hidden, answers_feats)
 
         elif position == len(question_feats):
-            out, _ = model.lstm(torch.autograd.Variable(question_feats[-1]).unsqueeze(0).unsqueeze(0))
+            out, _ = model.lstm(question_feats[-1].unsqueeze(0).unsqueeze(0))
             out = out.data
             fw_hidden = out[0, :question_feats.size(0), :out.size(2) // 2][-1].view(1, -1)
-            pred = predict_single_direction(torch.autograd.Variable(fw_hidden),
-                                            torch.autograd.Variable(answers_feats))
+            pred = predict_single_direction(fw_hidden, answers_feats)
 
         else:
             prev = question_feats[:position]
-            prev_out, _ = model.lstm(torch.autograd.Variable(prev[-1]).unsqueeze(0).unsqueeze(0))
+            prev_out, _ = model.lstm(prev[-1].unsqueeze(0).unsqueeze(0))
             prev_out = prev_out.data
             fw_hidden = prev_out[0, :prev.size(0), :prev_out.size(2) // 2][-1].view(1, -1)
 
             post = question_feats[position:]
-            post_out, _ = model.lstm(torch.autograd.Variable(post[0]).unsqueeze(0).unsqueeze(0))
+            post_out, _ = model.lstm(post[0].unsqueeze(0).unsqueeze(0))
             post_out = post_out.data
             bw_hidden = post_out[0, :post.size(0), post_out.size(2) // 2:][0].view(1, -1)
 
-            pred = predict_multi_direction(torch.autograd.Variable(fw_hidden),
-                                           torch.autograd.Variable(bw_hidden),
-                                           torch.autograd.Variable(answers_feats))
+            pred = predict_multi_direction(fw_hidden, bw_hidden, answers_feats)
 
         create_img_fitb(outfit, pred[0].data[0], os.path.join(img_savepath, "%d_score%.2f.jpg" % (i, pred[1].data[0]*100)))
         scores.append(pred)
@@ -53,7 +53,7 @@ def get_features(model_name, feats_filename, model_type):
         test_files = json.load(open(os.path.join(json_dir, json_filenames['test'])))
 
         filenames = []
-        features = torch.Tensor().cuda()
+        features = []
 
         for i, (test_file, batch) in enumerate(zip(test_files, dataloaders['test'])):
             if i == 0:
@@ -67,9 +67,12 @@ def get_features(model_name, feats_filename, model_type):
             im_feats = evaluator.get_img_feats(batch[0]['images'])
             for idx in im_idxs:
                 filenames.append(set_id + '_' + str(idx))
-            features = torch.cat((features, im_feats.data))
+            features.append(im_feats.data)
             for ignored in batch[0]['ignored']:
                 filenames.remove(ignored)
+        # Concatenate once at the end instead of copying all the previous features for every set
+        # (an empty loader still gives an empty tensor).
+        features = torch.cat(features) if features else torch.Tensor()
         if not os.path.exists(os.path.dirname(feats_filename)):
             os.makedirs(os.path.dirname(feats_filename))
         filenames = [n.encode("ascii", "ignore") for n in filenames]
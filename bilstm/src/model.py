@@ -1,14 +1,140 @@
 """Full Bi-LSTM network."""
 # pylint: disable=W0221
 # pylint: disable=E1101
+import math
+from typing import List
 import torch
+from torch import Tensor
 import torch.nn as nn
-import torch.autograd as autograd
-from torch.nn.utils.rnn import pack_padded_sequence
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pack_sequence
+from torch.nn.utils.rnn import pad_packed_sequence
 import torchvision.models as models
-from torchvision.models.inception import model_urls
 
-model_urls['inception_v3_google'] = model_urls['inception_v3_google'].replace('https://', 'http://')
+try:
+    from torchvision.models.inception import model_urls
+    model_urls['inception_v3_google'] = model_urls['inception_v3_google'].replace('https://', 'http://')
+except ImportError:
+    # torchvision >= 0.15 keeps the urls in the weights enums instead.
+    pass
+
+
+# Disable too-many-arguments.
+# pylint: disable=R0913
+@torch.jit.script
+def script_lstm_layer(inputs, mask, hx, cx, w_ih, w_hh, b_ih, b_hh):
+    """Run one direction of a LSTM layer over a padded batch with TorchScript.
+
+    The pointwise operations of the gates are fused by the TorchScript fuser, and the input
+    projection is computed for all time steps with a single matmul.
+
+    Args:
+        - inputs: padded inputs (max_seq_len x batch_size x input_dim).
+        - mask: bool mask of the valid time steps (max_seq_len x batch_size x 1).
+        - hx, cx: initial hidden and cell states (batch_size x hidden_dim).
+        - w_ih, w_hh, b_ih, b_hh: LSTM weights and biases (as in nn.LSTM).
+
+    Returns:
+        - outputs (max_seq_len x batch_size x hidden_dim), zero at padded steps.
+        - (hx, cx): hidden and cell states at the last valid step of each sequence.
+
+    """
+    x_gates = torch.matmul(inputs, w_ih.t()) + b_ih
+    outputs = torch.jit.annotate(List[Tensor], [])
+    for step in range(inputs.size(0)):
+        gates = x_gates[step] + torch.mm(hx, w_hh.t()) + b_hh
+        ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+        cy = torch.sigmoid(forgetgate) * cx + torch.sigmoid(ingate) * torch.tanh(cellgate)
+        hy = torch.sigmoid(outgate) * torch.tanh(cy)
+        # Padded steps keep the previous states.
+        hx = torch.where(mask[step], hy, hx)
+        cx = torch.where(mask[step], cy, cx)
+        outputs.append(hy.masked_fill(~mask[step], 0.))
+    return torch.stack(outputs), hx, cx
+# pylint: enable=R0913
+
+
+class ScriptBiLSTM(nn.Module):
+    """Single layer bidirectional LSTM running each direction with script_lstm_layer.
+
+    Drop-in replacement of nn.LSTM(input_dim, hidden_dim, bidirectional=True) for small batches,
+    where the Python overhead of nn.LSTM dominates (e.g. on CPU). Parameters are named as in
+    nn.LSTM, so saved weights can be loaded by either implementation.
+
+    Args:
+        - input_dim: (int) dimension of the input.
+        - hidden_dim: (int) dimension of the hidden state (of each direction).
+        - [batch_first]: (bool) layout of the (not packed) input and output tensors.
+
+    """
+
+    def __init__(self, input_dim, hidden_dim, batch_first=False):
+        """Create the LSTM parameters."""
+        super(ScriptBiLSTM, self).__init__()
+        self.input_size = input_dim
+        self.hidden_size = hidden_dim
+        self.batch_first = batch_first
+        for suffix in ['_l0', '_l0_reverse']:
+            self.register_parameter('weight_ih' + suffix,
+                                    nn.Parameter(torch.Tensor(4 * hidden_dim, input_dim)))
+            self.register_parameter('weight_hh' + suffix,
+                                    nn.Parameter(torch.Tensor(4 * hidden_dim, hidden_dim)))
+            self.register_parameter('bias_ih' + suffix, nn.Parameter(torch.Tensor(4 * hidden_dim)))
+            self.register_parameter('bias_hh' + suffix, nn.Parameter(torch.Tensor(4 * hidden_dim)))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        """Initialize the parameters as in nn.LSTM."""
+        stdv = 1.0 / math.sqrt(self.hidden_size)
+        for weight in self.parameters():
+            nn.init.uniform_(weight, -stdv, stdv)
+
+    def forward(self, inputs, hidden=None):
+        """Do a forward pass through both directions.
+
+        Args:
+            - inputs: PackedSequence or padded tensor with the input sequences.
+            - [hidden]: tuple (h_0, c_0) of initial states (2 x batch_size x hidden_dim).
+
+        Returns:
+            Same as nn.LSTM: (outputs, (h_n, c_n)), with outputs packed if inputs were packed.
+
+        """
+        if isinstance(inputs, PackedSequence):
+            padded, seq_lens = pad_packed_sequence(inputs)
+        else:
+            padded = inputs.transpose(0, 1) if self.batch_first else inputs
+            seq_lens = torch.full((padded.size(1),), padded.size(0), dtype=torch.long)
+        max_seq_len, batch_size = padded.size(0), padded.size(1)
+        lens = seq_lens.to(padded.device)
+
+        if hidden is None:
+            zeros = padded.new_zeros((2, batch_size, self.hidden_size))
+            hidden = (zeros, zeros)
+
+        steps = torch.arange(max_seq_len, device=padded.device).unsqueeze(1)
+        mask = (steps < lens).unsqueeze(2)
+        # The backward direction reads every sequence reversed within its own length.
+        rev_idxs = torch.where(steps < lens, lens - 1 - steps, steps)
+        rev_idxs = rev_idxs.unsqueeze(2).expand(-1, -1, padded.size(2))
+
+        fw_out, fw_h, fw_c = script_lstm_layer(padded, mask, hidden[0][0], hidden[1][0],
+                                               self.weight_ih_l0, self.weight_hh_l0,
+                                               self.bias_ih_l0, self.bias_hh_l0)
+        bw_out, bw_h, bw_c = script_lstm_layer(padded.gather(0, rev_idxs), mask,
+                                               hidden[0][1], hidden[1][1],
+                                               self.weight_ih_l0_reverse, self.weight_hh_l0_reverse,
+                                               self.bias_ih_l0_reverse, self.bias_hh_l0_reverse)
+        bw_out = bw_out.gather(0, rev_idxs[:, :, :1].expand(-1, -1, bw_out.size(2)))
+
+        out = torch.cat((fw_out, bw_out), 2)
+        if isinstance(inputs, PackedSequence):
+            out = pack_padded_sequence(out, seq_lens, enforce_sorted=False)
+        elif self.batch_first:
+            out = out.transpose(0, 1)
+        return out, (torch.stack((fw_h, bw_h)), torch.stack((fw_c, bw_c)))
+
+    def flatten_parameters(self):
+        """Do nothing: kept for interface compatibility with nn.LSTM (no cuDNN weights here)."""
 
 
 class FullBiLSTM(nn.Module):
@@ -20,29 +146,47 @@ class FullBiLSTM(nn.Module):
         - vocab_size: (int) size of the text vocabulary
         - [batch_first]: (bool) parameter of the PackedSequence data.
         - [dropout]: (float) dropout value for LSTM.
-        - [freeze]: (bool) whether to freeze or not the CNN part.
+        - [freeze]: (bool) whether to freeze or not the CNN part. A frozen CNN always runs in
+          evaluation mode (batch norm statistics are not updated and the auxiliary classifier
+          of Inception-v3 is not computed).
+        - [script_lstm]: (bool) use the TorchScript ScriptBiLSTM instead of nn.LSTM
+          (faster for small batches without cuDNN; dropout does not apply to it).
+        - [amp_dtype]: (torch.dtype) if given (e.g. torch.bfloat16), run the CNN and the LSTM
+          with CUDA autocast in this dtype. Features and outputs are returned in float32.
 
     """
 
     # Disable too-many-arguments.
     # pylint: disable=R0913
     def __init__(self, input_dim, hidden_dim, vocab_size,
-                 batch_first=False, dropout=0, freeze=False):
+                 batch_first=False, dropout=0, freeze=False, script_lstm=False,
+                 amp_dtype=None):
         """Create the network."""
         super(FullBiLSTM, self).__init__()
         self.input_dim = input_dim
         self.hidden_dim = hidden_dim
         self.batch_first = batch_first
         self.vocab_size = vocab_size
+        self.amp_dtype = amp_dtype
+        self.freeze = freeze
         self.textn = nn.Linear(vocab_size, input_dim)
         self.cnn = models.inception_v3(pretrained=True)
         if freeze:
             for param in self.cnn.parameters():
                 param.requires_grad = False
+            self.cnn.aux_logits = False
+            self.cnn.eval()
         self.cnn.fc = nn.Linear(2048, input_dim)
-        self.lstm = nn.LSTM(input_dim, hidden_dim, num_layers=1,
-                            batch_first=self.batch_first, bidirectional=True,
-                            dropout=dropout)
+        if script_lstm:
+            self.lstm = ScriptBiLSTM(input_dim, hidden_dim, batch_first=self.batch_first)
+        else:
+            self.lstm = nn.LSTM(input_dim, hidden_dim, num_layers=1,
+                                batch_first=self.batch_first, bidirectional=True,
+                                dropout=dropout)
+        # Keep the LSTM weights in a single contiguous chunk for the fused cuDNN kernel.
+        self.lstm.flatten_parameters()
+        # Storage reused by init_hidden for the initial states (not saved in the state_dict).
+        self.register_buffer('hidden_buffer', torch.empty(0), persistent=False)
 
     # Disable too-many-arguments and too-many-locals.
     # pylint: disable=R0913
@@ -57,12 +201,13 @@ class FullBiLSTM(nn.Module):
             - Doing the forward pass through the LSTM.
 
         Args:
-            - images: autograd Variable with the images of the batch.
+            - images: torch.Tensor with the images of the batch.
             - seq_lens: torch tensor with a list of the sequence lengths.
-            - im_lookup_table: list of lists with indices of the images.
+            - im_lookup_table: list of lists, or padded torch.LongTensor (batch_size x
+                max_seq_len), with indices of the images.
             - txt_lookup_table: list of lists with indices of the words in the texts.
             - hidden: hidden variables for the LSTM.
-            - texts: autograd Variable with a list of one-hot encoding matrices for
+            - texts: torch.Tensor with a list of one-hot encoding matrices for
                 texts (M words x N vocab_size).
 
         Returns:
@@ -72,9 +217,10 @@ class FullBiLSTM(nn.Module):
 
         """
         # Get image features:
-        im_feats, _ = self.cnn(images)
+        with self.amp_context(images):
+            im_feats = self.cnn_forward(images)
         # L2 norm as here: https://github.com/xthan/polyvore/blob/master/polyvore/polyvore_model_bi.py#L328
-        im_feats = torch.nn.functional.normalize(im_feats, p=2, dim=1)
+        im_feats = torch.nn.functional.normalize(im_feats.float(), p=2, dim=1)
 
         # Get word features:
         word_feats = self.textn(texts)
@@ -84,19 +230,21 @@ class FullBiLSTM(nn.Module):
         # Mean of word descriptors for each text:
         # txt_feats = [torch.mean(word_feats[i[0]:i[-1] + 1], 0)
         #              for batch in txt_lookup_table for i in batch]
-        txt_feats_matrix = autograd.Variable(torch.zeros(len(images), word_feats.size()[1]))
-        if im_feats[0].is_cuda:
-            txt_feats_matrix = txt_feats_matrix.cuda()
         table_idxs = [y for x in txt_lookup_table for y in x]
-        for i in range(txt_feats_matrix.size(0)):
-            # txt_feats_matrix[i, :] = feat
-            txt_feats_matrix[i, ] = torch.mean(word_feats[table_idxs[i]], 0)
+        # new_zeros allocates directly on the device of word_feats.
+        txt_feats_matrix = word_feats.new_zeros((len(images), word_feats.size(1)))
+        for i, word_idxs in enumerate(table_idxs):
+            txt_feats_matrix[i, ] = torch.mean(word_feats[word_idxs], 0)
         txt_feats_matrix = torch.nn.functional.normalize(txt_feats_matrix, p=2, dim=1)
 
         # Pack the sequences:
         packed_feats = self.create_packed_seq(im_feats, seq_lens, im_lookup_table)
-        # Forward the sequence through the LSTM:
-        return packed_feats, (im_feats, txt_feats_matrix), self.lstm(packed_feats, hidden)
+        # Forward the sequence through the LSTM (weights may be non contiguous after moving the
+        # model to another device or replicating it with DataParallel):
+        self.lstm.flatten_parameters()
+        with self.amp_context(images):
+            out, hidden = self.lstm(packed_feats, hidden)
+        return packed_feats, (im_feats, txt_feats_matrix), (out.float(), (hidden[0].float(), hidden[1].float()))
     # pylint: enable=R0913
     # pylint: enable=R0914
 
@@ -109,9 +257,10 @@ class FullBiLSTM(nn.Module):
             - Doing the forward pass through the LSTM.
 
         Args:
-            - images: autograd Variable with the images of the batch.
+            - images: torch.Tensor with the images of the batch.
             - seq_lens: torch tensor with a list of the sequence lengths.
-            - im_lookup_table: list of lists with indices of the images.
+            - im_lookup_table: list of lists, or padded torch.LongTensor (batch_size x
+                max_seq_len), with indices of the images.
             - hidden: hidden variables for the LSTM.
 
         Returns:
@@ -119,28 +268,67 @@ class FullBiLSTM(nn.Module):
 
         """
         # Get image features:
-        im_feats, _ = self.cnn(images)
+        with self.amp_context(images):
+            im_feats = self.cnn_forward(images)
         # Pack the sequences:
-        packed_feats = self.create_packed_seq(im_feats, seq_lens, im_lookup_table)
+        packed_feats = self.create_packed_seq(im_feats.float(), seq_lens, im_lookup_table)
         # Forward the sequence through the LSTM:
-        return self.lstm(packed_feats, hidden)
+        self.lstm.flatten_parameters()
+        with self.amp_context(images):
+            out, hidden = self.lstm(packed_feats, hidden)
+        return out.float(), (hidden[0].float(), hidden[1].float())
+
+    def train(self, mode=True):
+        """Set the training mode of the network, keeping a frozen CNN in evaluation mode."""
+        super(FullBiLSTM, self).train(mode)
+        if self.freeze:
+            self.cnn.eval()
+        return self
+
+    def cnn_forward(self, images):
+        """Get the CNN features of the images, ignoring the auxiliary Inception-v3 logits."""
+        im_feats = self.cnn(images)
+        # In training mode, Inception-v3 also returns the auxiliary logits.
+        if isinstance(im_feats, tuple):
+            im_feats = im_feats[0]
+        return im_feats
+
+    def amp_context(self, images):
+        """Get the autocast context of the CNN/LSTM forward (disabled without amp_dtype or GPU)."""
+        return torch.autocast('cuda', dtype=self.amp_dtype or torch.bfloat16,
+                              enabled=self.amp_dtype is not None and images.is_cuda)
 
     def init_hidden(self, batch_size):
-        """Initialize the hidden state and cell state."""
-        return (autograd.Variable(torch.rand(2, batch_size, self.hidden_dim) * 2 * 0.08),  # https://github.com/xthan/polyvore/blob/master/polyvore/polyvore_model_bi.py#L55
-                autograd.Variable(torch.rand(2, batch_size, self.hidden_dim) * 2 * 0.08))
+        """Initialize the hidden state and cell state (on the same device as the model).
+
+        The states are views of a buffer that is refilled in place on every call (it only grows
+        when a larger batch arrives), so they are only valid until the next call.
+
         """
-        return (autograd.Variable(torch.randn(2, batch_size, self.hidden_dim)),
-        autograd.Variable(torch.randn(2, batch_size, self.hidden_dim)))
+        size = 2 * batch_size * self.hidden_dim
+        if self.hidden_buffer.numel() < 2 * size:
+            self.hidden_buffer = self.hidden_buffer.new_empty(2 * size)
+        # https://github.com/xthan/polyvore/blob/master/polyvore/polyvore_model_bi.py#L55
+        self.hidden_buffer[:2 * size].uniform_(0, 2 * 0.08)
+        return (self.hidden_buffer[:size].view(2, batch_size, self.hidden_dim),
+                self.hidden_buffer[size:2 * size].view(2, batch_size, self.hidden_dim))
+        """
+        return (torch.randn(2, batch_size, self.hidden_dim),
+        torch.randn(2, batch_size, self.hidden_dim))
         """
 
-    def create_packed_seq(self, feats, seq_lens, im_lookup_table):
+    @staticmethod
+    def create_packed_seq(feats, seq_lens, im_lookup_table):
         """Create a packed input of sequences for a RNN.
 
+        Sequences do not need to be sorted by length: the PackedSequence keeps their original
+        order, which pad_packed_sequence restores.
+
         Args:
             - feats: torch.Tensor with data features (N imgs x feat_dim).
             - seq_lens: sequence lengths.
-            - im_lookup_table: list of image indices from seqs2batch.
+            - im_lookup_table: image indices from seqs2batch, either a padded torch.LongTensor
+                (batch_size x max_seq_len) or a list of lists.
             - data: list (with length batch_size) of sequences of images (shaped seq_len x img_dim).
 
         Returns:
@@ -148,26 +336,17 @@ class FullBiLSTM(nn.Module):
                                     max_seq_len x batch_size x img_dim otherwise).
 
         """
-        # Manually create the padded sequence.
-        if feats.is_cuda:
-            seqs = autograd.Variable(torch.zeros((len(seq_lens), max(seq_lens),
-                                                  feats.size()[1]))).cuda()
+        seq_lens = torch.as_tensor(seq_lens, dtype=torch.long)
+        if torch.is_tensor(im_lookup_table):
+            # Keep the valid (non padded) positions, in sequence order.
+            steps = torch.arange(im_lookup_table.size(1), device=im_lookup_table.device)
+            idxs = im_lookup_table[steps < seq_lens.to(im_lookup_table.device).unsqueeze(1)]
         else:
-            seqs = autograd.Variable(torch.zeros((len(seq_lens), max(seq_lens), feats.size()[1])))
-
-        for i, seq_len in enumerate(seq_lens):  # Iterate over batch
-            for j in range(max(seq_lens)):  # Iterate over sequence
-                if j < seq_len:
-                    seqs[i, j] = feats[im_lookup_table[i][j]]
-                else:
-                    seqs[i, j] = autograd.Variable(torch.zeros(feats.size()[1]))
-
-        # In order to be packed, sequences must be ordered from larger to shorter.
-        seqs = seqs[sorted(range(len(seq_lens)), key=lambda k: seq_lens[k], reverse=True), :]
-        ordered_seq_lens = sorted(seq_lens, reverse=True)
-
-        # seqs is (batch size, max length, data_dim)
-        if not self.batch_first:
-            seqs = seqs.permute(1, 0, 2)  # now it is (max length, max length, data_dim)
+            idxs = torch.as_tensor([idx for seq_lookup, seq_len in zip(im_lookup_table,
+                                                                       seq_lens.tolist())
+                                    for idx in seq_lookup[:seq_len]], dtype=torch.long)
+        # Gather the features of all the sequences at once (no padded copy), then split them.
+        seqs = feats.index_select(0, idxs.to(feats.device)).split(seq_lens.tolist())
 
-        return pack_padded_sequence(seqs, ordered_seq_lens, batch_first=self.batch_first)
+        # Sequences do not need to be ordered from larger to shorter (enforce_sorted=False).
+        return pack_sequence(seqs, enforce_sorted=False)
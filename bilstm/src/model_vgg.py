@@ -3,13 +3,16 @@
 # pylint: disable=E1101
 import torch
 import torch.nn as nn
-import torch.autograd as autograd
-from torch.nn.utils.rnn import pack_padded_sequence
+from torch.nn.utils.rnn import pack_sequence
 import torchvision.models as models
-from torchvision.models.vgg import model_urls
 from torchvision import transforms
 
-model_urls['vgg16_bn'] = model_urls['vgg16_bn'].replace('https://', 'http://')
+try:
+    from torchvision.models.vgg import model_urls
+    model_urls['vgg16_bn'] = model_urls['vgg16_bn'].replace('https://', 'http://')
+except ImportError:
+    # torchvision >= 0.15 keeps the urls in the weights enums instead.
+    pass
 
 
 class FullBiLSTM(nn.Module):
@@ -22,19 +25,22 @@ class FullBiLSTM(nn.Module):
         - [batch_first]: (bool) parameter of the PackedSequence data.
         - [dropout]: (float) dropout value for LSTM.
         - [freeze]: (bool) whether to freeze or not the CNN part.
+        - [amp_dtype]: (torch.dtype) if given (e.g. torch.bfloat16), run the CNN and the LSTM
+          with CUDA autocast in this dtype. Features and outputs are returned in float32.
 
     """
 
     # Disable too-many-arguments.
     # pylint: disable=R0913
     def __init__(self, input_dim, hidden_dim, vocab_size,
-                 batch_first=False, dropout=0, freeze=False):
+                 batch_first=False, dropout=0, freeze=False, amp_dtype=None):
         """Create the network."""
         super(FullBiLSTM, self).__init__()
         self.input_dim = input_dim
         self.hidden_dim = hidden_dim
         self.batch_first = batch_first
         self.vocab_size = vocab_size
+        self.amp_dtype = amp_dtype
         self.textn = nn.Linear(vocab_size, input_dim)
         self.cnn = models.vgg16_bn(pretrained=True)
         if freeze:
@@ -44,6 +50,10 @@ class FullBiLSTM(nn.Module):
         self.lstm = nn.LSTM(input_dim, hidden_dim, num_layers=1,
                             batch_first=self.batch_first, bidirectional=True,
                             dropout=dropout)
+        # Keep the LSTM weights in a single contiguous chunk for the fused cuDNN kernel.
+        self.lstm.flatten_parameters()
+        # Storage reused by init_hidden for the initial states (not saved in the state_dict).
+        self.register_buffer('hidden_buffer', torch.empty(0), persistent=False)
 
     # Disable too-many-arguments and too-many-locals.
     # pylint: disable=R0913
@@ -58,12 +68,13 @@ class FullBiLSTM(nn.Module):
             - Doing the forward pass through the LSTM.
 
         Args:
-            - images: autograd Variable with the images of the batch.
+            - images: torch.Tensor with the images of the batch.
             - seq_lens: torch tensor with a list of the sequence lengths.
-            - im_lookup_table: list of lists with indices of the images.
+            - im_lookup_table: list of lists, or padded torch.LongTensor (batch_size x
+                max_seq_len), with indices of the images.
             - txt_lookup_table: list of lists with indices of the words in the texts.
             - hidden: hidden variables for the LSTM.
-            - texts: autograd Variable with a list of one-hot encoding matrices for
+            - texts: torch.Tensor with a list of one-hot encoding matrices for
                 texts (M words x N vocab_size).
 
         Returns:
@@ -73,9 +84,10 @@ class FullBiLSTM(nn.Module):
 
         """
         # Get image features:
-        im_feats = self.cnn(images)
+        with self.amp_context(images):
+            im_feats = self.cnn(images)
         # L2 norm as here: https://github.com/xthan/polyvore/blob/master/polyvore/polyvore_model_bi.py#L328
-        im_feats = torch.nn.functional.normalize(im_feats, p=2, dim=1)
+        im_feats = torch.nn.functional.normalize(im_feats.float(), p=2, dim=1)
 
         # Get word features:
         word_feats = self.textn(texts)
@@ -85,19 +97,21 @@ class FullBiLSTM(nn.Module):
         # Mean of word descriptors for each text:
         # txt_feats = [torch.mean(word_feats[i[0]:i[-1] + 1], 0)
         #              for batch in txt_lookup_table for i in batch]
-        txt_feats_matrix = autograd.Variable(torch.zeros(len(images), word_feats.size()[1]))
-        if im_feats[0].is_cuda:
-            txt_feats_matrix = txt_feats_matrix.cuda()
         table_idxs = [y for x in txt_lookup_table for y in x]
-        for i in range(txt_feats_matrix.size(0)):
-            # txt_feats_matrix[i, :] = feat
-            txt_feats_matrix[i, ] = torch.mean(word_feats[table_idxs[i]], 0)
+        # new_zeros allocates directly on the device of word_feats.
+        txt_feats_matrix = word_feats.new_zeros((len(images), word_feats.size(1)))
+        for i, word_idxs in enumerate(table_idxs):
+            txt_feats_matrix[i, ] = torch.mean(word_feats[word_idxs], 0)
         txt_feats_matrix = torch.nn.functional.normalize(txt_feats_matrix, p=2, dim=1)
 
         # Pack the sequences:
         packed_feats = self.create_packed_seq(im_feats, seq_lens, im_lookup_table)
-        # Forward the sequence through the LSTM:
-        return packed_feats, (im_feats, txt_feats_matrix), self.lstm(packed_feats, hidden)
+        # Forward the sequence through the LSTM (weights may be non contiguous after moving the
+        # model to another device or replicating it with DataParallel):
+        self.lstm.flatten_parameters()
+        with self.amp_context(images):
+            out, hidden = self.lstm(packed_feats, hidden)
+        return packed_feats, (im_feats, txt_feats_matrix), (out.float(), (hidden[0].float(), hidden[1].float()))
     # pylint: enable=R0913
     # pylint: enable=R0914
 
@@ -110,9 +124,10 @@ class FullBiLSTM(nn.Module):
             - Doing the forward pass through the LSTM.
 
         Args:
-            - images: autograd Variable with the images of the batch.
+            - images: torch.Tensor with the images of the batch.
             - seq_lens: torch tensor with a list of the sequence lengths.
-            - im_lookup_table: list of lists with indices of the images.
+            - im_lookup_table: list of lists, or padded torch.LongTensor (batch_size x
+                max_seq_len), with indices of the images.
             - hidden: hidden variables for the LSTM.
 
         Returns:
@@ -120,28 +135,52 @@ class FullBiLSTM(nn.Module):
 
         """
         # Get image features:
-        im_feats, _ = self.cnn(images)
+        with self.amp_context(images):
+            im_feats, _ = self.cnn(images)
         # Pack the sequences:
-        packed_feats = self.create_packed_seq(im_feats, seq_lens, im_lookup_table)
+        packed_feats = self.create_packed_seq(im_feats.float(), seq_lens, im_lookup_table)
         # Forward the sequence through the LSTM:
-        return self.lstm(packed_feats, hidden)
+        self.lstm.flatten_parameters()
+        with self.amp_context(images):
+            out, hidden = self.lstm(packed_feats, hidden)
+        return out.float(), (hidden[0].float(), hidden[1].float())
+
+    def amp_context(self, images):
+        """Get the autocast context of the CNN/LSTM forward (disabled without amp_dtype or GPU)."""
+        return torch.autocast('cuda', dtype=self.amp_dtype or torch.bfloat16,
+                              enabled=self.amp_dtype is not None and images.is_cuda)
 
     def init_hidden(self, batch_size):
-        """Initialize the hidden state and cell state."""
-        return (autograd.Variable(torch.rand(2, batch_size, self.hidden_dim) * 2 * 0.08),  # https://github.com/xthan/polyvore/blob/master/polyvore/polyvore_model_bi.py#L55
-                autograd.Variable(torch.rand(2, batch_size, self.hidden_dim) * 2 * 0.08))
+        """Initialize the hidden state and cell state (on the same device as the model).
+
+        The states are views of a buffer that is refilled in place on every call (it only grows
+        when a larger batch arrives), so they are only valid until the next call.
+
+        """
+        size = 2 * batch_size * self.hidden_dim
+        if self.hidden_buffer.numel() < 2 * size:
+            self.hidden_buffer = self.hidden_buffer.new_empty(2 * size)
+        # https://github.com/xthan/polyvore/blob/master/polyvore/polyvore_model_bi.py#L55
+        self.hidden_buffer[:2 * size].uniform_(0, 2 * 0.08)
+        return (self.hidden_buffer[:size].view(2, batch_size, self.hidden_dim),
+                self.hidden_buffer[size:2 * size].view(2, batch_size, self.hidden_dim))
         """
-        return (autograd.Variable(torch.randn(2, batch_size, self.hidden_dim)),
-        autograd.Variable(torch.randn(2, batch_size, self.hidden_dim)))
+        return (torch.randn(2, batch_size, self.hidden_dim),
+        torch.randn(2, batch_size, self.hidden_dim))
         """
 
-    def create_packed_seq(self, feats, seq_lens, im_lookup_table):
+    @staticmethod
+    def create_packed_seq(feats, seq_lens, im_lookup_table):
         """Create a packed input of sequences for a RNN.
 
+        Sequences do not need to be sorted by length: the PackedSequence keeps their original
+        order, which pad_packed_sequence restores.
+
         Args:
             - feats: torch.Tensor with data features (N imgs x feat_dim).
             - seq_lens: sequence lengths.
-            - im_lookup_table: list of image indices from seqs2batch.
+            - im_lookup_table: image indices from seqs2batch, either a padded torch.LongTensor
+                (batch_size x max_seq_len) or a list of lists.
             - data: list (with length batch_size) of sequences of images (shaped seq_len x img_dim).
 
         Returns:
@@ -149,26 +188,17 @@ class FullBiLSTM(nn.Module):
                                     max_seq_len x batch_size x img_dim otherwise).
 
         """
-        # Manually create the padded sequence.
-        if feats.is_cuda:
-            seqs = autograd.Variable(torch.zeros((len(seq_lens), max(seq_lens),
-                                                  feats.size()[1]))).cuda()
+        seq_lens = torch.as_tensor(seq_lens, dtype=torch.long)
+        if torch.is_tensor(im_lookup_table):
+            # Keep the valid (non padded) positions, in sequence order.
+            steps = torch.arange(im_lookup_table.size(1), device=im_lookup_table.device)
+            idxs = im_lookup_table[steps < seq_lens.to(im_lookup_table.device).unsqueeze(1)]
         else:
-            seqs = autograd.Variable(torch.zeros((len(seq_lens), max(seq_lens), feats.size()[1])))
-
-        for i, seq_len in enumerate(seq_lens):  # Iterate over batch
-            for j in range(max(seq_lens)):  # Iterate over sequence
-                if j < seq_len:
-                    seqs[i, j] = feats[im_lookup_table[i][j]]
-                else:
-                    seqs[i, j] = autograd.Variable(torch.zeros(feats.size()[1]))
-
-        # In order to be packed, sequences must be ordered from larger to shorter.
-        seqs = seqs[sorted(range(len(seq_lens)), key=lambda k: seq_lens[k], reverse=True), :]
-        ordered_seq_lens = sorted(seq_lens, reverse=True)
-
-        # seqs is (batch size, max length, data_dim)
-        if not self.batch_first:
-            seqs = seqs.permute(1, 0, 2)  # now it is (max length, max length, data_dim)
-
-        return pack_padded_sequence(seqs, ordered_seq_lens, batch_first=self.batch_first)
+            idxs = torch.as_tensor([idx for seq_lookup, seq_len in zip(im_lookup_table,
+                                                                       seq_lens.tolist())
+                                    for idx in seq_lookup[:seq_len]], dtype=torch.long)
+        # Gather the features of all the sequences at once (no padded copy), then split them.
+        seqs = feats.index_select(0, idxs.to(feats.device)).split(seq_lens.tolist())
+
+        # Sequences do not need to be ordered from larger to shorter (enforce_sorted=False).
+        return pack_sequence(seqs, enforce_sorted=False)
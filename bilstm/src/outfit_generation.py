@@ -23,9 +23,9 @@ def get_img_path(img_name):
 
 def run_one_lstm(model, feats, direction, hidden=None):
     if not hidden:
-        out, hidden = model.lstm(torch.autograd.Variable(feats).unsqueeze(0))
+        out, hidden = model.lstm(feats.unsqueeze(0))
     else:
-        out, hidden = model.lstm(torch.autograd.Variable(feats).unsqueeze(0), hidden)
+        out, hidden = model.lstm(feats.unsqueeze(0), hidden)
     out = out.data
     if direction == 'f':
         return out[0, :feats.size(0), :out.size(2) // 2][-1].view(1, -1), hidden
@@ -40,9 +40,7 @@ def run_forward_lstm(model, prev_prod, answers_feats, data_dict, zero_idx, cuda)
     forward_seq = []
     while len(prev_prod) < 10:
         fw_hidden, _ = run_one_lstm(model, prev_prod, 'f')
-        pred = predict_single_direction(torch.autograd.Variable(fw_hidden),
-                                        torch.autograd.Variable(answers_feats),
-                                        zero_idx)
+        pred = predict_single_direction(fw_hidden, answers_feats, zero_idx)
         # Added list beacuse in python3 keys() is not subscriptable
         max_prob_img = list(data_dict.keys())[pred[0].data[0]]
         # removed the [0] to solve o dim index
@@ -63,9 +61,7 @@ def run_backward_lstm(model, next_prod, answers_feats, data_dict, zero_idx, cuda
     backward_seq = []
     while len(next_prod) < 10:
         bw_hidden, _ = run_one_lstm(model, next_prod, 'b')
-        pred = predict_single_direction(torch.autograd.Variable(bw_hidden),
-                                        torch.autograd.Variable(answers_feats),
-                                        zero_idx)
+        pred = predict_single_direction(bw_hidden, answers_feats, zero_idx)
         # removed the [0] to solve o dim index, added list for non subscriptable
         max_prob_img = list(data_dict.keys())[pred[0].data]
         # removed the [0] to solve o dim index
@@ -91,9 +87,7 @@ def run_fill_lstm(model, start_feats, end_feats, num_blank, answers_feats, data_
     for i in range(num_blank):
         fw_hidden, _ = run_one_lstm(model, start_feats, 'f')
         forward_hiddens.append(fw_hidden)
-        pred = predict_single_direction(torch.autograd.Variable(fw_hidden),
-                                        torch.autograd.Variable(answers_feats),
-                                        zero_idx)
+        pred = predict_single_direction(fw_hidden, answers_feats, zero_idx)
         # Added list for non subscriptable
         max_prob_img = list(data_dict.keys())[pred[0].data[0]]
         forward_seq.append(max_prob_img)
@@ -108,9 +102,7 @@ def run_fill_lstm(model, start_feats, end_feats, num_blank, answers_feats, data_
     for i in range(num_blank):
         bw_hidden, _ = run_one_lstm(model, end_feats, 'b')
         backward_hiddens.append(bw_hidden)
-        pred = predict_single_direction(torch.autograd.Variable(bw_hidden),
-                                        torch.autograd.Variable(answers_feats),
-                                        zero_idx)
+        pred = predict_single_direction(bw_hidden, answers_feats, zero_idx)
         # Added list for non subscriptable, removed [0]
         max_prob_img = list(data_dict.keys())[pred[0].data]
         # Removed the [0]
@@ -127,8 +119,7 @@ def run_fill_lstm(model, start_feats, end_feats, num_blank, answers_feats, data_
 
     hiddens = forward_hiddens + backward_hiddens
     hiddens = hiddens.view(len(hiddens), -1)
-    blank_scores = torch.nn.functional.log_softmax(torch.autograd.Variable(torch.mm(
-                                             hiddens, answers_feats.permute(1, 0))), dim=1)
+    blank_scores = torch.nn.functional.log_softmax(torch.mm(hiddens, answers_feats.permute(1, 0)), dim=1)
     _, blank_idxs = torch.max(blank_scores, 1)
     #Added list and removed [0]
     blank_imgs = [list(data_dict.keys())[idx.data] for idx in blank_idxs]
@@ -152,9 +143,9 @@ def nn_search(img, text_feat, data_dict, answers_feats, cuda, balance_factor = 2
     img_feat = torch.nn.functional.normalize(img_feat, p=2, dim=1)
     if cuda:
         img_feat = img_feat.cuda()
-    scores = torch.nn.functional.log_softmax(torch.autograd.Variable(
-                                             torch.mm((img_feat + balance_factor * text_feat.data).view(1, 512),
-                                                      answers_feats.permute(1, 0))), dim=1)
+    scores = torch.nn.functional.log_softmax(
+        torch.mm((img_feat + balance_factor * text_feat.data).view(1, 512),
+                 answers_feats.permute(1, 0)), dim=1)
     _, idx = torch.max(scores, 1)
     return data_dict.keys()[idx.data[0]]
 
@@ -277,7 +268,6 @@ def main(model_name, model_type, feats_name, img_savepath, query_file, vocab_fil
         if len(query['text_query']):
             text_query = txt_norm(query['text_query'])
             texts = torch.stack([get_one_hot(word, vocab) for word in text_query.split()])
-            texts = torch.autograd.Variable(texts)
             if cuda:
                 texts = texts.cuda()
             text_query_feat = model.textn(texts)
@@ -25,25 +25,23 @@ def seqs2batch(data, word_to_ix):
         - texts: torch.Tensor of stacked one-hot encoding matrices for texts (M words x
                                                                               N vocab_size).
         - seq_lens: list of sequence lengths.
-        - im_lookup_table: list (shaped batch_size x seq_len, with seq_len variable) containing
-          the indices of images in the image list.
+        - im_lookup_table: torch.LongTensor (batch_size x max_seq_len) containing the indices of
+          images in the image list (-1 at the padded positions).
         - txt_lookup_table: list (shaped batch_size x seq_len x text_len, with seq_len and
           text_len variable) containing the indices of words in the text list.
 
     """
     # Get all inputs and keep the information about the sequence they belong to.
-    images = torch.Tensor()
-    texts = torch.Tensor()
+    images = []
+    texts = []
     # img_data, txt_data = zip([(i['images'], i['texts']) for i in data])
     img_data = [i['images'] for i in data]
     txt_data = [i['texts'] for i in data]
     seq_lens = torch.zeros(len(img_data)).int()
-    im_lookup_table = [None] * len(data)
     txt_lookup_table = [None] * len(data)
     count = 0
     word_count = 0
     for seq_tag, (seq_imgs, seq_txts) in enumerate(zip(img_data, txt_data)):
-        im_seq_lookup = []
         txt_seq_lookup = []
         for img, txt in zip(seq_imgs, seq_txts):
             text_to_append = range(word_count, word_count + len(txt.split()))
@@ -52,16 +50,24 @@ def seqs2batch(data, word_to_ix):
                 # plt.imshow(img.permute(1, 2, 0).numpy())
                 # plt.show()
                 continue
-            images = torch.cat((images, img.unsqueeze(0)))
-            texts = torch.cat((texts, get_one_hot(txt, word_to_ix)))
-            im_seq_lookup.append(count)
+            images.append(img)
+            texts.append(get_one_hot(txt, word_to_ix))
             txt_seq_lookup.append(range(word_count, word_count + len(txt.split())))
             count += 1
             word_count += len(txt.split())
             seq_lens[seq_tag] += 1
-        im_lookup_table[seq_tag] = im_seq_lookup
         txt_lookup_table[seq_tag] = txt_seq_lookup
 
+    # Copy everything once, instead of growing the tensors for each item.
+    images = torch.stack(images) if images else torch.Tensor()
+    texts = torch.cat(texts) if texts else torch.Tensor()
+
+    # Images are stored in sequence order, so the valid positions of the padded lookup table
+    # are just filled with consecutive indices.
+    max_seq_len = int(seq_lens.max()) if len(data) else 0
+    im_lookup_table = torch.full((len(data), max_seq_len), -1, dtype=torch.long)
+    im_lookup_table[torch.arange(max_seq_len) < seq_lens.long().unsqueeze(1)] = torch.arange(count)
+
     return images, texts, seq_lens, im_lookup_table, txt_lookup_table
 
 
@@ -1,7 +1,30 @@
 import unittest
 import torch
-from torch.nn.utils.rnn import pack_padded_sequence
-from bilstm.src.losses import LSTMLosses, SBContrastiveLoss
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from bilstm.src.losses import LSTMLosses, ContrastiveLoss, SBContrastiveLoss
+
+
+def reference_lstm_losses(packed_feats, hidden):
+    """Per-sequence log_softmax + diag loop the batched LSTMLosses replaced."""
+    feats, seq_lens = pad_packed_sequence(packed_feats, batch_first=True)
+    seq_lens = seq_lens.tolist()
+    x_values = torch.zeros(sum(seq_lens) + 2*len(seq_lens), feats.size(2))
+    start = 0
+    for feat, seq_len in zip(feats, seq_lens):
+        x_values[start + 1 : start + 1 + seq_len] = feat[:seq_len]
+        start += seq_len + 2
+
+    fw_loss, bw_loss = 0, 0
+    seq_idx_start = 0
+    for i, seq_len in enumerate(seq_lens):
+        fw_logprob = torch.nn.functional.log_softmax(
+            torch.mm(hidden[i, :seq_len, :hidden.size(2) // 2], x_values.t()), dim=1)
+        bw_logprob = torch.nn.functional.log_softmax(
+            torch.mm(hidden[i, :seq_len, hidden.size(2) // 2:], x_values.t()), dim=1)
+        fw_loss += - torch.diag(fw_logprob[:, seq_idx_start + 2 : seq_idx_start + 2 + seq_len]).mean()
+        bw_loss += - torch.diag(bw_logprob[:, seq_idx_start : seq_idx_start + seq_len]).mean()
+        seq_idx_start += seq_len + 2
+    return fw_loss / len(seq_lens), bw_loss / len(seq_lens)
 
 
 class TestLosses(unittest.TestCase):
@@ -12,26 +35,74 @@ class TestLosses(unittest.TestCase):
         feats_len = 3
 
         seq_lens = [max_seq_len, max_seq_len]
-        feats = torch.autograd.Variable(torch.zeros(len(seq_lens), max_seq_len, feats_len))
+        feats = torch.zeros(len(seq_lens), max_seq_len, feats_len)
         packed_batch = pack_padded_sequence(feats, seq_lens, batch_first=True)
 
-        out = torch.autograd.Variable(torch.zeros(len(seq_lens), max_seq_len, 2*feats_len))
+        out = torch.zeros(len(seq_lens), max_seq_len, 2*feats_len)
+
+        criterion = LSTMLosses(batch_first=True)
+        fw_loss, bw_loss = criterion(packed_batch, out)
+        # 2 sequences of 2 items + start/stop symbols: uniform over 8 candidates (log(8)).
+        self.assertAlmostEqual(fw_loss.item(), 2.07944154, places=5)
+        self.assertAlmostEqual(bw_loss.item(), 2.07944154, places=5)
+
+    def test_LSTMLosses_unsorted(self):
+
+        torch.manual_seed(0)
+        max_seq_len = 3
+        feats_len = 4
+        seq_lens = [3, 1, 2]
+
+        feats = torch.randn(len(seq_lens), max_seq_len, feats_len)
+        packed_batch = pack_padded_sequence(feats, seq_lens, batch_first=True,
+                                            enforce_sorted=False)
+        out = torch.randn(len(seq_lens), max_seq_len, 2*feats_len)
 
-        criterion = LSTMLosses(batch_first=True, cuda=False)
+        criterion = LSTMLosses(batch_first=True)
         fw_loss, bw_loss = criterion(packed_batch, out)
-        self.assertAlmostEqual(fw_loss.data[0], 0.34657359)
-        self.assertAlmostEqual(bw_loss.data[0], 0.34657359)
+        ref_fw_loss, ref_bw_loss = reference_lstm_losses(packed_batch, out)
+        self.assertAlmostEqual(fw_loss.item(), ref_fw_loss.item(), places=5)
+        self.assertAlmostEqual(bw_loss.item(), ref_bw_loss.item(), places=5)
+
+    def test_ContrastiveLoss(self):
+
+        feats1 = torch.zeros(2, 1)
+        feats2 = torch.Tensor([[1], [3]])
+        labels = torch.Tensor([0, 1])
+
+        closs = ContrastiveLoss(margin=2.0)
+        loss = closs(feats1, feats2, labels)
+        self.assertAlmostEqual(loss.item(), 0.5, places=5)
 
     def test_SBContrastiveLoss(self):
 
         feats_len = 3
-        feats1 = torch.autograd.Variable(torch.zeros(1, feats_len))
-        feats2 = torch.autograd.Variable(torch.zeros(1, feats_len))
-        labels = 1
+        feats1 = torch.zeros(1, feats_len)
+        feats2 = torch.zeros(1, feats_len)
 
+        # A single pair only has the matching term, which is compensated.
         closs = SBContrastiveLoss(margin=0.2)
-        loss = closs(feats1, feats2, labels)
-        self.assertAlmostEqual(loss.data[0], 0.03999930)
+        loss = closs(feats1, feats2)
+        self.assertAlmostEqual(loss.item(), 0.0, places=6)
+
+        torch.manual_seed(0)
+        margin = 0.2
+        descs1 = torch.randn(5, feats_len)
+        descs2 = torch.randn(5, feats_len)
+        closs = SBContrastiveLoss(margin=margin)
+        loss = closs(descs1, descs2)
+
+        # Unscripted expression with an explicit zero tensor in torch.max.
+        zero_comp = torch.Tensor([0])
+        dists = torch.mm(descs1, descs2.permute(1, 0))
+        same_dists = torch.diag(dists)
+        desc1_loss = torch.sum(torch.max(zero_comp, margin - same_dists.unsqueeze(1) + dists))\
+            - margin * len(same_dists)
+        desc2_loss = torch.sum(torch.max(zero_comp, margin - same_dists.unsqueeze(0) + dists))\
+            - margin * len(same_dists)
+        ref_loss = (desc1_loss + desc2_loss) / (descs1.size()[0]**2)
+        self.assertGreater(ref_loss.item(), 0)
+        self.assertAlmostEqual(loss.item(), ref_loss.item(), places=5)
 
 
 if __name__ == '__main__':
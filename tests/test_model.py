@@ -1,7 +1,8 @@
 import unittest
 import torch
-from torch.nn.utils.rnn import pad_packed_sequence
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from bilstm.src.model import FullBiLSTM as model
+from bilstm.src.model import ScriptBiLSTM
 
 
 class TestModel(unittest.TestCase):
@@ -16,9 +17,7 @@ class TestModel(unittest.TestCase):
         lookup_table = [[0, 1], [2, 3], [4]]
         net = model(input_dim, hidden_dim, batch_first)
 
-        inputs = torch.autograd.Variable(
-            torch.randn(5, 3, size, size).type(torch.FloatTensor),
-            requires_grad=False)
+        inputs = torch.randn(5, 3, size, size)
 
         out, hidden = net(inputs, init_seq_lens, lookup_table, net.init_hidden(3))
         out, seq_lens = pad_packed_sequence(out, batch_first=batch_first)
@@ -26,6 +25,44 @@ class TestModel(unittest.TestCase):
         self.assertEqual(seq_lens, init_seq_lens)
         self.assertEqual(hidden[0][1], [3, 2])
 
+    def test_create_packed_seq(self):
+
+        feats = torch.randn(6, 4)
+        init_seq_lens = [1, 3, 2]
+        lookup_table = [[5], [0, 1, 2], [4, 3]]
+
+        packed = model.create_packed_seq(feats, init_seq_lens, lookup_table)
+        seqs, seq_lens = pad_packed_sequence(packed, batch_first=True)
+        self.assertEqual(seq_lens.tolist(), init_seq_lens)
+        for seq, seq_len, lookup in zip(seqs, init_seq_lens, lookup_table):
+            self.assertTrue(torch.equal(seq[:seq_len], feats[lookup]))
+            self.assertEqual(seq[seq_len:].abs().sum().item(), 0)
+
+        padded_table = torch.LongTensor([[5, -1, -1], [0, 1, 2], [4, 3, -1]])
+        padded_packed = model.create_packed_seq(feats, init_seq_lens, padded_table)
+        self.assertTrue(torch.equal(padded_packed.data, packed.data))
+
+    def test_ScriptBiLSTM(self):
+
+        input_dim = 4
+        hidden_dim = 3
+        init_seq_lens = [3, 1, 2]
+        lstm = torch.nn.LSTM(input_dim, hidden_dim, batch_first=True, bidirectional=True)
+        script_lstm = ScriptBiLSTM(input_dim, hidden_dim, batch_first=True)
+        script_lstm.load_state_dict(lstm.state_dict())
+
+        inputs = pack_padded_sequence(torch.randn(3, 3, input_dim), init_seq_lens,
+                                      batch_first=True, enforce_sorted=False)
+        out, (h_n, c_n) = lstm(inputs)
+        script_out, (script_h_n, script_c_n) = script_lstm(inputs)
+
+        out, _ = pad_packed_sequence(out, batch_first=True)
+        script_out, seq_lens = pad_packed_sequence(script_out, batch_first=True)
+        self.assertEqual(seq_lens.tolist(), init_seq_lens)
+        self.assertTrue(torch.allclose(out, script_out, atol=1e-6))
+        self.assertTrue(torch.allclose(h_n, script_h_n, atol=1e-6))
+        self.assertTrue(torch.allclose(c_n, script_c_n, atol=1e-6))
+
 
 if __name__ == '__main__':
     unittest.main()
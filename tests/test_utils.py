@@ -2,7 +2,8 @@ import unittest
 import torch
 import nltk
 from PIL import Image
-from bilstm.src.utils import seqs2batch, ImageTransforms, TextTransforms
+from bilstm.src.utils import seqs2batch, create_vocab, ImageTransforms, TextTransforms
+from bilstm.src.model import FullBiLSTM
 nltk.download('wordnet')
 
 
@@ -12,15 +13,40 @@ class TestUtils(unittest.TestCase):
     def test_seqs2batch(self):
 
         img = torch.randn(20, 20, 3)
-        data = [{'images': [img, img]}]*4
-        images, seq_lens, lookup_table = seqs2batch(data)
+        data = [{'images': [img, img], 'texts': ['a b', 'c']}]*4
+        word_to_ix = create_vocab(['a b c'])
+        images, texts, seq_lens, lookup_table, _ = seqs2batch(data, word_to_ix)
 
         self.assertTrue(len(seq_lens) == len(data) == len(images)/2)
-        self.assertTrue(lookup_table == [[0, 1], [2, 3], [4, 5], [6, 7]])
+        self.assertEqual(texts.size(), torch.Size([12, 3]))
+        self.assertTrue(lookup_table.tolist() == [[0, 1], [2, 3], [4, 5], [6, 7]])
 
-        images, seq_lens, lookup_table = seqs2batch([])
+        images, texts, seq_lens, lookup_table, _ = seqs2batch([], word_to_ix)
         self.assertTrue(len(images) == len(seq_lens) == len(lookup_table) == 0)
 
+    def test_seqs2batch_padded(self):
+
+        imgs = [torch.full((3, 2, 2), i) for i in range(7)]
+        # Items without text are skipped, so sequences end up with different lengths.
+        data = [{'images': imgs[:3], 'texts': ['a b', '', 'c']},
+                {'images': imgs[3:4], 'texts': ['d']},
+                {'images': imgs[4:], 'texts': ['', 'e f', 'a']}]
+        word_to_ix = create_vocab(['a b c d e f'])
+        images, texts, seq_lens, lookup_table, txt_lookup_table = seqs2batch(data, word_to_ix)
+
+        self.assertEqual(seq_lens.tolist(), [2, 1, 2])
+        self.assertEqual(lookup_table.tolist(), [[0, 1], [2, -1], [3, 4]])
+        self.assertEqual(images[:, 0, 0, 0].tolist(), [0, 2, 3, 5, 6])
+        self.assertEqual(texts.size(), torch.Size([7, 6]))
+        self.assertEqual([[list(r) for r in seq] for seq in txt_lookup_table],
+                         [[[0, 1], [2]], [[3]], [[4, 5], [6]]])
+
+        feats = torch.randn(5, 4)
+        packed = FullBiLSTM.create_packed_seq(feats, seq_lens, lookup_table)
+        list_packed = FullBiLSTM.create_packed_seq(feats, seq_lens, [[0, 1], [2], [3, 4]])
+        self.assertTrue(torch.equal(packed.data, list_packed.data))
+        self.assertTrue(torch.equal(packed.batch_sizes, list_packed.batch_sizes))
+
 
     def test_ImageTransforms(self):
 